@@ -1,10 +1,16 @@
 import os
 import re
+import threading
 from argparse import ArgumentParser, FileType
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from urllib.parse import urlparse, urlunparse
+import cachetools
+import orjson
 import requests
-from github import Github, Project
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 try:
@@ -14,12 +20,43 @@ except:
     pass
 
 
+_MILESTONE_RE = re.compile(r'/repos/([^/]+)/([^/]+)/milestones/(\d+)')
+_ORG_PROJ_RE = re.compile(r'^/orgs/([^/]+)/projects/(\d+)$')
+_REPO_PROJ_RE = re.compile(r'^/([^/]+/[^/]+)/projects/(\d+)$')
+_CDATA_RE = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+
+
+def _make_session(retry_methods=None):
+    # Without `retry_methods` urllib3 only retries its default idempotent
+    # methods.  It renamed `method_whitelist` to `allowed_methods` in 1.26.
+    retry_kwargs = dict(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    if retry_methods is None:
+        retry = Retry(**retry_kwargs)
+    else:
+        try:
+            retry = Retry(allowed_methods=retry_methods, **retry_kwargs)
+        except TypeError:
+            retry = Retry(method_whitelist=retry_methods, **retry_kwargs)
+
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=retry))
+    return session
+
+
+# Shared sessions so every call to the GitHub API reuses pooled connections
+# rather than paying for a fresh TCP+TLS handshake each time.  GraphQL reads
+# are POSTs too, so they get their own session that retries POST; mutations
+# go through `_SESSION`, which only retries the idempotent methods.
+_SESSION = _make_session()
+_READ_SESSION = _make_session(frozenset({'GET', 'HEAD', 'POST'}))
+
+
 def get_milestone_html_url(milestone):
     milestone_api_url = milestone.url
 
     milestone_api_path = urlparse(milestone_api_url).path
 
-    matches = re.match(r'/repos/([^/]+)/([^/]+)/milestones/(\d+)', milestone_api_path)
+    matches = _MILESTONE_RE.match(milestone_api_path)
 
     org, repo, number = matches.groups()
 
@@ -28,23 +65,30 @@ def get_milestone_html_url(milestone):
     return urlunparse(('https', 'github.com', milestone_path, '', '', ''))
 
 
+# We can't use lru_cache for card contents because `card` is not hashable,
+# so cache on `card.id` instead, bounded so long-running processes don't grow
+# without limit.  A sentinel distinguishes a cached `None` from a miss.
+_CARD_CONTENT_CACHE = cachetools.LRUCache(maxsize=1024)
+_CARD_CONTENT_LOCK = threading.Lock()
+_SENTINEL = object()
+
+
 def get_card_content(card):
-    # We can't use lru_cache here because `card` is not hashable.
-    # Unfortunately.
-    # In place of that we're just using a memoization off of the
-    # function called.  It's hacky but.. well, better than nothing, right?
+    cid = card.id
 
-    if not hasattr(get_card_content, '_card_content_memo'):
-        setattr(get_card_content, '_card_content_memo', {})
-    memo = getattr(get_card_content, '_card_content_memo')
+    with _CARD_CONTENT_LOCK:
+        hit = _CARD_CONTENT_CACHE.get(cid, _SENTINEL)
+    if hit is not _SENTINEL:
+        return hit
 
-    if card.id not in memo:
-        try:
-            memo[card.id] = card.get_content()
-        except:
-            memo[card.id] = None
+    try:
+        content = card.get_content()
+    except:
+        content = None
 
-    return memo.get(card.id, None)
+    with _CARD_CONTENT_LOCK:
+        _CARD_CONTENT_CACHE[cid] = content
+    return content
 
 
 def format_card(card):
@@ -62,7 +106,7 @@ def format_card(card):
 
     # We've wrapped stuff in CDATA to prevent it from messing up the github pages.
     # If there's anything that's CDATA let's pull it outta there.
-    line = re.sub(r'<!\[CDATA\[(.*?)\]\]>', '\g<1>', line, flags=re.MULTILINE | re.DOTALL)
+    line = _CDATA_RE.sub(r'\1', line)
 
     if not line:
         return None
@@ -75,12 +119,27 @@ def format_card(card):
 
 
 def format_cards(cards):
+    # Fetching a card's content is a round-trip to the API, so prime the cache
+    # concurrently; formatting below then only ever hits the cache.
+    cards = list(cards)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(get_card_content, cards))
+
     return list(filter(None, [format_card(card) for card in cards]))
 
 
 def convert_to_markdown(json_data):
     # Dictionary to hold the categorized items
-    categorized_items = {}
+    categorized_items = defaultdict(list)
+
+    # Field values only carry their field's id; resolve names from the
+    # project's field list, fetched once alongside the items.
+    fields = json_data["data"]["node"].get("fields") or {}
+    field_id_to_name = {
+        field["id"]: field["name"]
+        for field in fields.get("nodes") or []
+        if field
+    }
 
     # Iterate over the items and categorize them by status
     for item in json_data["data"]["node"]["items"]["nodes"]:
@@ -88,42 +147,93 @@ def convert_to_markdown(json_data):
         status = None
         title = None
         for field in item["fieldValues"]["nodes"]:
-            if field.get("field", {}).get("name") == "Status":
+            field_info = field.get("field")
+            if not field_info:
+                continue
+            name = field_id_to_name.get(field_info.get("id"))
+            if name == "Status":
                 status = field.get("name")
-            elif field.get("field", {}).get("name") == "Title":
+            elif name == "Title":
                 title = field.get("text")
+            if status and title:
+                break
         
         # If status is found, add the item to the category
         if status and title:
-            if status not in categorized_items:
-                categorized_items[status] = []
             categorized_items[status].append(title)
 
     # Now convert the categorized items to markdown format
-    markdown_output = "# Project Board Status\n\n"
+    parts = ["# Project Board Status\n\n"]
     for status, titles in categorized_items.items():
-        markdown_output += f"## {status}\n"
-        for title in titles:
-            markdown_output += f"- [ ] {title}\n"  # Using task list format
-        markdown_output += "\n"  # Add a newline for formatting
+        parts.append(f"## {status}\n")
+        parts.extend(f"- [ ] {title}\n" for title in titles)  # Using task list format
+        parts.append("\n")  # Add a newline for formatting
+
+    return "".join(parts)
+
+
+class GraphQLError(Exception):
+    """
+    Raised when GitHub answers a GraphQL query with an `errors` array.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(error.get('message', str(error)) for error in errors))
+
+
+def _graphql_post(payload, headers, session=_SESSION):
+    # Serialize with orjson ourselves rather than letting requests use json.dumps.
+    return session.post('https://api.github.com/graphql',
+                         data=orjson.dumps(payload),
+                         headers={**(headers or {}), "Content-Type": "application/json"})
 
-    return markdown_output
 
+# Short-lived cache of read-only GraphQL responses, so repeated reads of the
+# same project within a run don't go back over the network.
+_GRAPHQL_CACHE = cachetools.TTLCache(maxsize=128, ttl=30)
 
-def graphql_query(query, headers):
+
+def graphql_query(query, headers, variables=None, cache=True):
     """
     Helper function to perform a GraphQL query using the requests library.
+
+    Values should be passed through `variables` rather than formatted into
+    `query`, so the query text stays the same between calls.  Responses are
+    cached briefly unless `cache` is False, which mutations must pass.
     """
-    request = requests.post('https://api.github.com/graphql', json={'query': query}, headers=headers)
-    if request.status_code == 200:
-        return request.json()
-    else:
-        raise Exception("Query failed to run by returning code of {}. {}".format(request.status_code, query))
+    # Variables may hold lists or input objects, so key on their serialized form.
+    cache_key = (
+        query,
+        orjson.dumps(variables, option=orjson.OPT_SORT_KEYS),
+        (headers or {}).get("Authorization"),
+    )
+    if cache and cache_key in _GRAPHQL_CACHE:
+        return _GRAPHQL_CACHE[cache_key]
+
+    payload = {'query': query}
+    if variables is not None:
+        payload['variables'] = variables
+    request = _graphql_post(payload, headers, session=_READ_SESSION)
+    if not request.ok:
+        # Don't echo the query back; it can be several KB.
+        raise requests.HTTPError(
+            "Query failed to run by returning code of {}. {}".format(request.status_code, request.text[:512]),
+            response=request,
+        )
+
+    # GraphQL errors come back as a 200 with an `errors` array rather than data.
+    response_json = orjson.loads(request.content)
+    if "errors" in response_json:
+        raise GraphQLError(response_json["errors"])
+
+    if cache:
+        _GRAPHQL_CACHE[cache_key] = response_json
+    return response_json
 
 def get_login_and_project_number_from_uri(uri):
     # Extract the org, repo, and project number from the URI
     project_path = urlparse(uri).path
-    matches = re.match(r'^/orgs/([^/]+)/projects/(\d+)$', project_path) or re.match(r'^/([^/]+/[^/]+)/projects/(\d+)$', project_path)
+    matches = _ORG_PROJ_RE.match(project_path) or _REPO_PROJ_RE.match(project_path)
     if not matches:
         raise ValueError(f"Invalid project URI: {uri}")
 
@@ -133,21 +243,24 @@ def get_login_and_project_number_from_uri(uri):
     }
     return variables["login"], variables["projectNumber"]
 
+@lru_cache(maxsize=None)
 def get_project_node_id_from_uri(token, uri):
     headers = {"Authorization": f"bearer {token}"}
 
     query = """
-    query{
-        organization(login: "%s"){
-            projectV2(number: %i) {
+    query($login: String!, $number: Int!) {
+        organization(login: $login){
+            projectV2(number: $number) {
                 id
             }
         }
     }
-    """ % get_login_and_project_number_from_uri(uri)
+    """
+    login, number = get_login_and_project_number_from_uri(uri)
+    variables = {"login": login, "number": number}
 
     # Perform the query
-    project_id_response = graphql_query(query, headers)
+    project_id_response = graphql_query(query, headers, variables)
     # print(f"project_id_response: {project_id_response}")
     node_id = project_id_response['data']['organization']['projectV2']['id']
     print(f"project node_id: {node_id}")
@@ -161,12 +274,25 @@ def get_project_contents(token, uri):
         "Content-Type": "application/json"
     }
 
-    # The GraphQL query. Be sure to replace PROJECT_ID with your actual Project ID
+    # The GraphQL query. Only the fields convert_to_markdown reads are requested,
+    # and items are fetched a page at a time until the project is exhausted.
     query = """
-    query {
-    node(id: "%s") {
+    query($id: ID!, $cursor: String, $withFields: Boolean!) {
+    node(id: $id) {
         ... on ProjectV2 {
-        items(first: 20) {
+        fields(first: 50) @include(if: $withFields) {
+            nodes {
+            ... on ProjectV2FieldCommon {
+                id
+                name
+            }
+            }
+        }
+        items(first: 100, after: $cursor) {
+            pageInfo {
+            endCursor
+            hasNextPage
+            }
             nodes {
             id
             fieldValues(first: 8) {
@@ -175,15 +301,7 @@ def get_project_contents(token, uri):
                     text
                     field {
                     ... on ProjectV2FieldCommon {
-                        name
-                    }
-                    }
-                }
-                ... on ProjectV2ItemFieldDateValue {
-                    date
-                    field {
-                    ... on ProjectV2FieldCommon {
-                        name
+                        id
                     }
                     }
                 }
@@ -191,30 +309,8 @@ def get_project_contents(token, uri):
                     name
                     field {
                     ... on ProjectV2FieldCommon {
-                        name
-                    }
-                    }
-                }
-                }
-            }
-            content {
-                ... on DraftIssue {
-                title
-                body
-                }
-                ... on Issue {
-                title
-                assignees(first: 10) {
-                    nodes {
-                    login
+                        id
                     }
-                }
-                }
-                ... on PullRequest {
-                title
-                assignees(first: 10) {
-                    nodes {
-                    login
                     }
                 }
                 }
@@ -224,84 +320,153 @@ def get_project_contents(token, uri):
         }
     }
     }
-    """ % node_id
-
-    # Perform the query
-    project_id_response = graphql_query(query, headers)
+    """
 
+    # Perform the query, following the cursor across every page of items.
+    # The project's fields are only requested with the first page.
+    fields = None
+    nodes = []
+    cursor = None
+    while True:
+        first_page = cursor is None
+        page = graphql_query(query, headers, {"id": node_id, "cursor": cursor, "withFields": first_page})
+        if first_page:
+            fields = page['data']['node'].get('fields')
+        items = page['data']['node']['items']
+        nodes.extend(items['nodes'])
+        if not items['pageInfo']['hasNextPage']:
+            break
+        cursor = items['pageInfo']['endCursor']
+
+    project_id_response = {"data": {"node": {"fields": fields, "items": {"nodes": nodes}}}}
 
     # For now, this will just print the raw response
     # print(project_id_response)
-    return project_id_response
+    return node_id, project_id_response
 
 
 def get_issues_from_repo(token, org, repo):
     headers = {"Authorization": f"token {token}"}
     url = f"https://api.github.com/repos/{org}/{repo}/issues"
-    response = requests.get(url, headers=headers)
+    response = _READ_SESSION.get(url, headers=headers)
     if response.status_code == 200:
-        return response.json()
+        return orjson.loads(response.content)
     else:
         raise Exception("Failed to retrieve issues: {}".format(response.status_code))
 
 
+# Number of aliased mutations sent per GraphQL request.  Kept well below
+# GitHub's node/complexity limits; batches that still trip them are retried
+# one mutation at a time.
+MUTATION_BATCH_SIZE = 25
+
+
+# GraphQL error types GitHub uses when a query is rejected for its size or
+# cost rather than its content.
+_QUERY_LIMIT_ERROR_TYPES = frozenset({"MAX_NODE_LIMIT_EXCEEDED", "RESOURCE_LIMITS_EXCEEDED"})
+
+
+def _is_complexity_error(response_json):
+    return any(
+        error.get('type') in _QUERY_LIMIT_ERROR_TYPES
+        for error in response_json.get('errors') or []
+    )
+
+
+def _batched_mutation(headers, variable_types, fields, variables):
+    """
+    Send several mutations as a single request by aliasing each one.
+
+    `fields` is a list of aliased mutation fields (e.g. `a0: addProjectV2ItemById(...) { ... }`)
+    and `variable_types` maps each variable name used by those fields to its GraphQL type.
+    Returns the decoded response, or None if GitHub rejected the batch as too complex.
+    """
+    signature = ", ".join(f"${name}: {type_}" for name, type_ in variable_types.items())
+    mutation = "mutation(%s) {\n%s\n}" % (signature, "\n".join(fields))
+
+    response = _graphql_post({'query': mutation, 'variables': variables}, headers)
+    if response.status_code != 200:
+        raise Exception(f"Batched mutation failed: {response.status_code}")
+
+    response_json = orjson.loads(response.content)
+    if _is_complexity_error(response_json):
+        return None
+    return response_json
+
+
+def _add_items_to_project(headers, project_node_id, issues):
+    variable_types = {"projectId": "ID!"}
+    variables = {"projectId": project_node_id}
+    fields = []
+    for i, issue in enumerate(issues):
+        variable_types[f"contentId{i}"] = "ID!"
+        variables[f"contentId{i}"] = issue['node_id']
+        fields.append(
+            f"a{i}: addProjectV2ItemById(input: {{projectId: $projectId, contentId: $contentId{i}}}) {{ item {{ id }} }}"
+        )
+
+    response_json = _batched_mutation(headers, variable_types, fields, variables)
+    if response_json is None:
+        if len(issues) == 1:
+            raise Exception(f"Failed to add issue {issues[0]['title']} to project: query too complex")
+        return [item_id for issue in issues for item_id in _add_items_to_project(headers, project_node_id, [issue])]
+
+    data = response_json.get('data') or {}
+    item_ids = []
+    for i, issue in enumerate(issues):
+        added = data.get(f"a{i}")
+        if not added:
+            raise Exception(f"Failed to add issue {issue['title']} to project: {response_json.get('errors')}")
+        item_ids.append(added['item']['id'])
+    return item_ids
+
+
+def _set_items_status(headers, item_ids, status_field_id, status_value):
+    # Setting the status is best-effort: failures are reported but don't stop
+    # the remaining issues being added or the markdown being written.
+    variable_types = {"fieldId": "ID!", "value": "String!"}
+    variables = {"fieldId": status_field_id, "value": status_value}
+    fields = []
+    for i, item_id in enumerate(item_ids):
+        variable_types[f"itemId{i}"] = "ID!"
+        variables[f"itemId{i}"] = item_id
+        fields.append(
+            f"s{i}: updateProjectV2ItemField(input: {{itemId: $itemId{i}, fieldId: $fieldId, value: $value}}) {{ item {{ id }} }}"
+        )
+
+    response_json = _batched_mutation(headers, variable_types, fields, variables)
+    if response_json is None:
+        if len(item_ids) == 1:
+            print(f"Failed to set status of item {item_ids[0]} to '{status_value}': query too complex")
+            return
+        for item_id in item_ids:
+            _set_items_status(headers, [item_id], status_field_id, status_value)
+        return
+
+    data = response_json.get('data') or {}
+    for i, item_id in enumerate(item_ids):
+        if not data.get(f"s{i}"):
+            print(f"Failed to set status of item {item_id} to '{status_value}': {response_json.get('errors')}")
+
+
 def add_issues_to_project(token, project_uri, issues):
     headers = {"Authorization": f"Bearer {token}"}
     
-    project = get_project_contents(token, project_uri)
     project_node_id = get_project_node_id_from_uri(token, project_uri)
 
-    for issue in issues:
-        # Construct the mutation query to add an issue to the project
-        add_item_mutation = """
-        mutation($projectId: ID!, $contentId: ID!) {
-            addProjectV2ItemById(input: {projectId: $projectId, contentId: $contentId}) {
-                item {
-                    id
-                }
-            }
-        }
-        """
-        variables = {
-            "projectId": project_node_id,
-            "contentId": issue['node_id']
-        }
-
-        # Perform the GraphQL mutation
-        add_response = requests.post('https://api.github.com/graphql',
-                                     json={'query': add_item_mutation, 'variables': variables},
-                                     headers=headers)
-        if add_response.status_code != 200:
-            raise Exception(f"Failed to add issue {issue['title']} to project: {add_response.status_code}")
-
-        # Update the status of the issue to 'Extracted'
-        update_status_mutation = """
-        mutation($itemId: ID!, $fieldId: ID!, $value: String!) {
-            updateProjectV2ItemField(input: {itemId: $itemId, fieldId: $fieldId, value: $value}) {
-                item {
-                    id
-                }
-            }
-        }
-        """
-        # You need to replace 'FIELD_ID' with the actual ID of the 'Status' field in your project
-        status_field_id = "Status"
-        status_value = "Extracted"
-        item_id = add_response.json()['data']['addProjectV2ItemById']['item']['id']
-
-        variables = {
-            "itemId": item_id,
-            "fieldId": status_field_id,
-            "value": status_value
-        }
-
-        update_response = requests.post('https://api.github.com/graphql',
-                                        json={'query': update_status_mutation, 'variables': variables},
-                                        headers=headers)
-        if update_response.status_code != 200:
-            raise Exception(f"Failed to set status of issue {issue['title']} to 'Extracted': {update_response.status_code}")
+    # You need to replace 'FIELD_ID' with the actual ID of the 'Status' field in your project
+    status_field_id = "Status"
+    status_value = "Extracted"
 
+    # Add the issues and then set their status to 'Extracted', a batch at a time,
+    # so that N issues cost a handful of round-trips rather than 2N.
+    for offset in range(0, len(issues), MUTATION_BATCH_SIZE):
+        batch = issues[offset:offset + MUTATION_BATCH_SIZE]
+        item_ids = _add_items_to_project(headers, project_node_id, batch)
+        _set_items_status(headers, item_ids, status_field_id, status_value)
 
+    # The project has changed, so any cached reads of it are now stale.
+    _GRAPHQL_CACHE.clear()
 
 
 def get_field_id(token, project_uri):
@@ -329,13 +494,11 @@ def get_field_id(token, project_uri):
 
     variables = {"projectId": project_node_id}
 
-    response = requests.post('https://api.github.com/graphql',
-                             json={'query': query, 'variables': variables},
-                             headers=headers)
+    response = _graphql_post({'query': query, 'variables': variables}, headers, session=_READ_SESSION)
 
     if response.status_code == 200:
-        print(response.json())
-        # fields = response.json()['data']['node']['fields']['nodes']
+        print(orjson.loads(response.content))
+        # fields = orjson.loads(response.content)['data']['node']['fields']['nodes']
         # for field in fields:
         #     print(f"Field Name: {field['name']}, Field ID: {field['id']}")
     else:
@@ -358,6 +521,7 @@ def cli():
     token = args.github_token
     output_file = args.output_file
     project_uri = args.project_uri
+
     if args.org and args.repo:
         issues = get_issues_from_repo(token, args.org, args.repo)
         print(f"issues: {issues}")
@@ -366,7 +530,7 @@ def cli():
     if args.get_field_id:
         get_field_id(args.github_token, args.project_uri)
 
-    project = get_project_contents(token, project_uri)
+    _, project = get_project_contents(token, project_uri)
 
     markdown = convert_to_markdown(project)
 
@@ -375,6 +539,9 @@ def cli():
     else:
         print(markdown)
 
+    _SESSION.close()
+    _READ_SESSION.close()
+
 
 if __name__ == "__main__":
     cli()